@@ -2,24 +2,45 @@ import os
 import io
 import asyncio
 import random
-import json
-from json import JSONEncoder
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from dotenv import load_dotenv
 from chess import Board, Move, pgn
-from chess import WHITE, BLACK
+from chess import WHITE, BLACK, STARTING_BOARD_FEN, Outcome, Termination
 from chess import InvalidMoveError, IllegalMoveError, AmbiguousMoveError
 from chess.pgn import StringExporter
-from PIL import Image
 import discord
 from discord.ext import commands
-from generator import Generator
+from storage import DBGameStates
 
 bot = commands.Bot(command_prefix="",
                    case_insensitive=True,
                    intents=discord.Intents.all())
 
 
+def _render_fen_to_image(board_fen: str, last_move_uci: str = None) -> bytes:
+    """
+    Render a board position to WebP image bytes.  This is CPU bound, so it runs in the render process pool, and only
+    takes picklable arguments for that reason.
+    :param board_fen: the piece placement part of the FEN of the position to render
+    :param last_move_uci: the last move played, in UCI notation, which is highlighted on the board
+    :return: the encoded WebP image
+    """
+    # Pillow is only needed by the render workers, so it's imported on the first render rather than with the bot
+    from generator import Generator
+
+    board = Board.empty()
+    board.set_board_fen(board_fen)
+    last_move = Move.from_uci(last_move_uci) if last_move_uci else None
+    image = Generator.generate(board, last_move)
+
+    with io.BytesIO() as binary:
+        # the flat board art compresses well at quality 80, and the slower method=4 encoder is worth it because the
+        # render runs off the event loop and is cached, while every byte is uploaded to Discord on each move
+        image.save(binary, "WEBP", quality=80, method=4)
+        return binary.getvalue()
+
+
 class Settings:
     """
     Contains all the high-level initialization and values that are needed elsewhere throughout the bot.
@@ -29,9 +50,11 @@ class Settings:
     bot_token = None
     storage_type = None
     database_url = None
+    database_socket_dir = None
 
     @classmethod
     def load_env_settings(cls):
+        from dotenv import load_dotenv
         load_dotenv()
 
         if os.getenv('GUILD_IDS'):
@@ -43,6 +66,7 @@ class Settings:
         cls.bot_token = os.getenv("TOKEN")
         cls.storage_type = os.getenv("STORAGE_TYPE")
         cls.database_url = os.getenv("DATABASE_URL")
+        cls.database_socket_dir = os.getenv("DATABASE_SOCKET_DIR")
 
     @classmethod
     def init(cls):
@@ -57,43 +81,105 @@ class GameStorage:
     db = None
 
     @classmethod
-    def init(cls):
+    async def init(cls):
         if Settings.storage_type and Settings.storage_type.lower() == 'postgres':
             from storage import postgres
-            cls.db = postgres.PostgresStorage(Settings.database_url)
+            cls.db = await postgres.PostgresStorage.create(Settings.database_url, Settings.database_socket_dir)
+
+    @classmethod
+    async def close(cls):
+        if cls.db:
+            await cls.db.close()
+            cls.db = None
 
 
 class Game:
     """
     Wrapper around the Chess library Board to keep track of the white/black players
-    and match_id reference for the DB
+    and match_id reference for the DB.
+
+    The board is usually loaded from a FEN, so it has no move stack.  The history of the game is kept separately
+    in `moves`, in UCI notation, for highlighting the last move and exporting the PGN.
     """
 
-    def __init__(self, white_id: int, black_id: int, match_id: int, rated: bool = True, last_move_san: str = None):
+    def __init__(self, white_id: int, black_id: int, match_id: int, rated: bool = True, last_move_san: str = None,
+                 fen: str = None, moves: list = None):
         self.white_id = white_id
         self.black_id = black_id
         self.match_id = match_id
         self.rated = rated
         self.last_move_san = last_move_san
-        self.board = Board()
+        self.board = Board(fen) if fen else Board()
+        self.moves = moves if moves is not None else []
+        self._end_state = None
 
+    def end_state(self) -> tuple:
+        """
+        Evaluate check and the outcome of the game together.  The Board end-of-game methods each generate the legal
+        moves on their own, so this asks for the outcome once and keeps the result until the next move is played.
+        :return: a tuple of (is_check, outcome), where outcome is None while the game is still in progress
+        """
+        if self._end_state is None:
+            outcome = self.board.outcome(claim_draw=False)
+            if outcome and outcome.termination == Termination.FIVEFOLD_REPETITION:
+                # repetition is read from the board's move stack, which only exists while the same Game stays cached
+                # rather than being loaded from a FEN, so it would end games depending on the cache, and outcome()
+                # checks it last, so no other end applies
+                outcome = None
+            self._end_state = (self.board.is_check(), outcome)
+        return self._end_state
+
+    def push(self, move: Move) -> None:
+        """
+        Play a legal move on the board and record it in the game history
+        :param move:
+        :return:
+        """
+        self.last_move_san = self.board.san(move)
+        self.board.push(move)
+        self.moves.append(move.uci())
+        self._end_state = None
 
-class GameEncoder(JSONEncoder):
-    """
-    We will be storing the entire Game object as JSON in the DB.  In order to
-    convert to JSON we need some custom serialization to occur for the Discord
-    related objects.
-    """
+    def to_dict(self) -> dict:
+        """
+        Build the minimal representation of the game that is persisted in the DB.  The FEN is enough to load the
+        board, and the move list keeps the game history.
+        :return: a dict containing only JSON serializable values
+        """
+        return {
+            "white_id": self.white_id,
+            "black_id": self.black_id,
+            "match_id": self.match_id,
+            "rated": self.rated,
+            "last_move_san": self.last_move_san,
+            "fen": self.board.fen(),
+            # a copy, so the saved state doesn't change when the next move is pushed
+            "moves": list(self.moves)
+        }
 
-    def default(self, o):
-        if isinstance(o, discord.member.Member) or isinstance(o, discord.user.User):
-            # Member doesn't support __dict__ and there's no point in storing the whole Member object
-            # because we can get the actual Member object later using just the ID.
-            return {
-                "id": o.id
-            }
-        else:
-            return o.__dict__
+    @classmethod
+    def from_dict(cls, game_dict: dict):
+        """
+        Build a new Game instance from the state stored by to_dict().  Game instances are only cached in memory, and
+        every move persists the current game state in the DB to protect against bot restarts from causing
+        matches to be disregarded.
+        :param game_dict: the stored game state, already decoded from JSON by the storage
+        :return: a fully populated Game instance
+        """
+        game = cls(white_id=game_dict['white_id'],
+                   black_id=game_dict['black_id'],
+                   match_id=game_dict['match_id'],
+                   rated=game_dict['rated'],
+                   last_move_san=game_dict['last_move_san'],
+                   fen=game_dict.get('fen'),
+                   moves=list(game_dict.get('moves', [])))
+
+        if 'fen' not in game_dict:
+            # games saved by older versions of the bot hold the serialized Board internals instead of a FEN, so
+            # only read the fields of each move in its move stack rather than restoring every Board attribute
+            for move in game_dict['board']['move_stack']:
+                game.push(Move(move['from_square'], move['to_square'], move['promotion'], move['drop']))
+        return game
 
 
 class Chess(commands.Cog):
@@ -124,8 +210,37 @@ class Chess(commands.Cog):
     * after a match is finishes the stats for both users are updated and a new match may be started if desired.
     """
 
+    # number of rendered board images kept in memory, keyed by position and last move
+    board_img_cache_size = 512
+    # number of decoded games, and their exported PGN, kept in memory, keyed by match_id
+    game_cache_size = 256
+    # number of channels whose last sent board image is kept in memory
+    last_board_image_cache_size = 256
+    # number of channels whose open invite, or lack of one, is kept in memory
+    open_invite_cache_size = 1024
+
     def __init__(self, bot):
         self.bot = bot
+        self._render_pool = ProcessPoolExecutor(max_workers=2)
+        self._board_img_cache = OrderedDict()
+        self._game_cache = OrderedDict()
+        self._pgn_cache = OrderedDict()
+        # the last board image sent to each channel, keyed by channel_id
+        self._last_board_image = OrderedDict()
+        self._starting_board_image = None
+        # the open invite of each channel, or None if it has no invite, keyed by channel_id
+        self._open_invites = OrderedDict()
+        # bumped by every change to the invites, so a read that overlapped one isn't cached
+        self._open_invites_generation = 0
+
+    async def cog_load(self) -> None:
+        # every match starts from the same board, so render it once up front and keep it out of the LRU cache
+        self._starting_board_image = await asyncio.get_running_loop().run_in_executor(self._render_pool,
+                                                                                      _render_fen_to_image,
+                                                                                      STARTING_BOARD_FEN)
+
+    async def cog_unload(self) -> None:
+        self._render_pool.shutdown(wait=False, cancel_futures=True)
 
     @staticmethod
     async def send_error(ctx, title: str = "Error", description: str = "General internal error") -> None:
@@ -137,48 +252,92 @@ class Chess(commands.Cog):
         embed.add_field(name=title, value=description, inline=True)
         await ctx.response.send_message(embed=embed)
 
+    @staticmethod
+    def _draw_reason(outcome: Outcome) -> str:
+        """
+        Describe why a game ended in a draw, for the board message
+        :param outcome: the drawn outcome of the game
+        :return:
+        """
+        if outcome.termination == Termination.STALEMATE:
+            return "Stalemate"
+        if outcome.termination == Termination.INSUFFICIENT_MATERIAL:
+            return "Insufficient material"
+        if outcome.termination == Termination.SEVENTYFIVE_MOVES:
+            return "Seventy-five move rule"
+        return "Draw"
+
     def _get_member_by_id(self, user_id):
         """
         We only keep track of user ids in the JSON game data, so when we need to display their name, we need to
-        look up the actual Discord User object
+        look up the actual Discord User object.  bot.get_user is already a lookup in discord.py's own user cache.
         :param user_id:
         :return: a Discord User object
         """
         return self.bot.get_user(user_id)
 
-    async def convert_game_state_to_game(self, game_state):
+    def _load_game(self, game_rec):
         """
-        Build a new Game instance from a JSON string.  Game instances are not kept around in memory, and
-        every move persists the current game state in the DB to protect against bot restarts from causing
-        matches to be disregarded.
-        :param game_state: a JSON string defining a Game object
+        Get the Game for a match record.  The decoded game is reused as long as the version of the stored game state
+        hasn't changed since it was cached, which skips the JSON decode and board rebuild for back to back commands.
+        :param game_rec: a match record returned by get_current_game
         :return: a fully populated Game instance
         """
-        new_game = Game(white_id=0, black_id=0, match_id=0)
-        game_dict = json.loads(game_state)
-        for key in game_dict.keys():
-            if key == 'white':
-                # get actual discord member object so that we have the properties to @mention them in messages
-                setattr(new_game, key, self._get_member_by_id(game_dict[key]['id']))
-            elif key == 'black':
-                # get actual discord member object so that we have the properties to @mention them in messages
-                setattr(new_game, key, self._get_member_by_id(game_dict[key]['id']))
-            elif key == 'board':
-                # the board must be instantiated as an actual Board object
-                setattr(new_game, key, Board())
-                for board_key in game_dict[key]:
-                    if board_key == 'move_stack':
-                        # the move stack must contain actual Move objects for when we show the last move on the board
-                        for move in game_dict[key][board_key]:
-                            new_game.board.move_stack.append(Move(move['from_square'],
-                                                                  move['to_square'],
-                                                                  move['promotion'],
-                                                                  move['drop']))
-                    else:
-                        setattr(new_game.board, board_key, game_dict[key][board_key])
-            else:
-                setattr(new_game, key, game_dict[key])
-        return new_game
+        cached = self._game_cache.get(game_rec['match_id'])
+        if cached and cached[0] == game_rec['version']:
+            self._game_cache.move_to_end(game_rec['match_id'])
+            return cached[1]
+
+        game = Game.from_dict(game_rec['game_state'])
+        self._cache_game(game_rec['version'], game)
+        return game
+
+    async def _cached_open_invite(self, channel_id):
+        """
+        Get the open invite for a channel, keeping it, or the lack of one, like the storage keeps the current match
+        so /accept, /decline and /cancel don't wait on the DB when nothing has changed.
+        :param channel_id:
+        :return: the invite record, or None if there is no open invite
+        """
+        if channel_id in self._open_invites:
+            self._open_invites.move_to_end(channel_id)
+            return self._open_invites[channel_id]
+
+        generation = self._open_invites_generation
+        invite = await GameStorage.db.get_open_invites(channel_id)
+        # an invite made or claimed while the query was running may be missing from its result
+        if generation == self._open_invites_generation:
+            self._cache_open_invite(channel_id, invite)
+        return invite
+
+    def _set_open_invite(self, channel_id, invite):
+        self._open_invites_generation += 1
+        self._cache_open_invite(channel_id, invite)
+
+    def _cache_open_invite(self, channel_id, invite):
+        self._open_invites[channel_id] = invite
+        self._open_invites.move_to_end(channel_id)
+        if len(self._open_invites) > self.open_invite_cache_size:
+            self._open_invites.popitem(last=False)
+
+    def _forget_open_invite(self, channel_id):
+        self._open_invites_generation += 1
+        self._open_invites.pop(channel_id, None)
+
+    def forget_open_invites(self):
+        """
+        Drop every cached open invite, such as after invites were imported with bulk_insert_matches, which the cog
+        doesn't otherwise hear about
+        :return:
+        """
+        self._open_invites_generation += 1
+        self._open_invites.clear()
+
+    def _cache_game(self, version, game):
+        self._game_cache[game.match_id] = (version, game)
+        self._game_cache.move_to_end(game.match_id)
+        if len(self._game_cache) > self.game_cache_size:
+            self._game_cache.popitem(last=False)
 
     @discord.app_commands.command(name="new",
                                   description="Start a new match against a specific opponent, or the first to accept")
@@ -190,18 +349,24 @@ class Chess(commands.Cog):
         :param rated:
         :return:
         """
-        if ctx.user == opponent:
+        if opponent is not None and opponent.id == ctx.user.id:
             return await self.send_error(ctx, description="You cannot challenge yourself")
 
-        game_rec = GameStorage.db.get_current_game(ctx.channel_id)
+        game_rec = await GameStorage.db.get_current_game(ctx.channel_id)
         if game_rec:
             return await self.send_error(ctx, description="Another game is already active in this channel.")
 
-        GameStorage.db.new_match(ctx.guild_id,
-                                 ctx.channel_id,
-                                 ctx.user.id,
-                                 opponent.id if opponent else None,
-                                 rated)
+        opponent_id = opponent.id if opponent else None
+        match_id = await GameStorage.db.new_match(ctx.guild_id,
+                                                  ctx.channel_id,
+                                                  ctx.user.id,
+                                                  opponent_id,
+                                                  rated)
+        self._set_open_invite(ctx.channel_id, {
+            "match_id": match_id,
+            "user_id": ctx.user.id,
+            "opponent_id": opponent_id
+        })
 
         rated_msg = "a `RATED`" if rated is True else "an `UNRATED`"
 
@@ -217,30 +382,36 @@ class Chess(commands.Cog):
     @discord.app_commands.command(name="decline",
                                   description="decline an active invitation in this channel")
     async def decline(self, ctx):
-        invite = GameStorage.db.get_open_invites(ctx.channel_id)
-        if invite and invite['opponent_id'] == ctx.user.id:
-            user = self._get_member_by_id(invite['user_id'])
-            GameStorage.db.decline_invite(invite['match_id'])
-            await ctx.response.send_message(f"You have declined the invite from {user.mention}.")
-            return
+        # a cached invite answers the checks without a DB round trip
+        invite = self._open_invites.get(ctx.channel_id)
+        if ctx.channel_id not in self._open_invites or (invite and invite['opponent_id'] == ctx.user.id):
+            invite = await GameStorage.db.decline_invite_in_channel(ctx.channel_id, ctx.user.id)
+            if invite:
+                self._forget_open_invite(ctx.channel_id)
+                user = self._get_member_by_id(invite['user_id'])
+                await ctx.response.send_message(f"You have declined the invite from {user.mention}.")
+                return
 
         return await self.send_error(ctx, "No invite was found to decline")
 
     @discord.app_commands.command(name="cancel",
                                   description="Cancel a new match that you invited people to in this channel")
     async def cancel(self, ctx):
-        invite = GameStorage.db.get_open_invites(ctx.channel_id)
-        if invite and invite['user_id'] == ctx.user.id:
-            GameStorage.db.cancel_invite(invite['match_id'])
-            await ctx.response.send_message(f"You have cancelled your invitation for a new match")
-            return
+        # a cached invite answers the checks without a DB round trip
+        invite = self._open_invites.get(ctx.channel_id)
+        if ctx.channel_id not in self._open_invites or (invite and invite['user_id'] == ctx.user.id):
+            invite = await GameStorage.db.cancel_invite_in_channel(ctx.channel_id, ctx.user.id)
+            if invite:
+                self._forget_open_invite(ctx.channel_id)
+                await ctx.response.send_message(f"You have cancelled your invitation for a new match")
+                return
 
         return await self.send_error(ctx, "You have no open invites exist, so there is nothing to cancel")
 
     @discord.app_commands.command(name="accept",
                                   description="Accept an invite to play chess")
     async def accept(self, ctx):
-        invite = GameStorage.db.get_open_invites(ctx.channel_id)
+        invite = await self._cached_open_invite(ctx.channel_id)
         if invite is None:
             return await self.send_error(ctx, "There are no invites for anybody in this channel.")
         print("channel_id", ctx.channel_id, "user", ctx.user.id, "invite", invite['user_id'])
@@ -252,13 +423,17 @@ class Chess(commands.Cog):
             return await self.send_error(ctx, "Sorry, the invite in this channel is for a specific user")
 
         user = self._get_member_by_id(invite['user_id'])
-        white_id, black_id = random.sample([user.id, ctx.user.id], 2)
+        if random.getrandbits(1):
+            white_id, black_id = user.id, ctx.user.id
+        else:
+            white_id, black_id = ctx.user.id, user.id
 
         game = Game(white_id, black_id, invite['match_id'])
 
-        game_state = json.dumps(game, cls=GameEncoder)
-        GameStorage.db.accept_invite(invite['match_id'], ctx.user.id)
-        GameStorage.db.save_game_state(invite['match_id'], game_state)
+        started = await GameStorage.db.start_match(invite['match_id'], ctx.channel_id, ctx.user.id, game.to_dict())
+        self._forget_open_invite(ctx.channel_id)
+        if not started:
+            return await self.send_error(ctx, "The invite in this channel is no longer open")
 
         await self.render_game_board(ctx, game)
 
@@ -271,34 +446,32 @@ class Chess(commands.Cog):
         :param move:
         :return:
         """
-        game_rec = GameStorage.db.get_current_game(ctx.channel_id)
+        game_rec = await GameStorage.db.get_current_game(ctx.channel_id)
         if not game_rec:
             return await self.send_error(ctx, description="No game is currently in progress")
 
-        current_game = await self.convert_game_state_to_game(game_rec['game_state'])
-
-        if ctx.user.id not in [current_game.white_id, current_game.black_id]:
+        # check the players against the DB record so that non-players don't trigger a parse of the game state
+        if ctx.user.id != game_rec['user_id'] and ctx.user.id != game_rec['opponent_id']:
             await ctx.response.send_message("Only the players of the current match can make moves")
             return
 
-        color = WHITE if self._get_member_by_id(current_game.white_id) == ctx.user else BLACK
+        current_game = self._load_game(game_rec)
+
+        color = WHITE if ctx.user.id == current_game.white_id else BLACK
         if color is not current_game.board.turn:
             return await self.send_error(ctx, "It is not your turn to make a move")
 
         """
         Attempt to determine if the specified move is in SAN or UCI notation. 
         """
-        board_move = None
         try:
-            # try UCI format first
-            board_move = Move.from_uci(move)
+            # try UCI format first, which parse_uci also checks for legality against the current board
+            board_move = current_game.board.parse_uci(move)
+        except IllegalMoveError:
+            return await self.send_error(ctx, description="Illegal move for the selected piece")
         except InvalidMoveError:
-            # ignore the exception as we'll see if it's SAN, and any SAN parse failures will raise an appropriate error
-            pass
-
-        if not board_move:
+            # not UCI, so see if it's SAN, and any SAN parse failures will raise an appropriate error
             try:
-                # try SAN format if UCI failed
                 board_move = current_game.board.parse_san(move)
             except IllegalMoveError:
                 return await self.send_error(ctx, description=f"Illegal move of {move}")
@@ -307,29 +480,37 @@ class Chess(commands.Cog):
             except InvalidMoveError:
                 return await self.send_error(ctx, description=f"Invalid move of {move}")
 
-        # This is necessary for a UCI move since that doesn't take the current state of the board into account.  SAN
-        # parsing does consider the current board.  So if SAN syntax is used this is redundant, but shouldn't conflict.
-        if board_move not in current_game.board.legal_moves:
-            return await self.send_error(ctx, description="Illegal move for the selected piece")
-
-        current_game.last_move_san = current_game.board.san(board_move)
-        current_game.board.push(board_move)
-
-        GameStorage.db.save_game_state(game_rec['match_id'], json.dumps(current_game, cls=GameEncoder))
-
-        if current_game.board.is_stalemate():
-            GameStorage.db.match_draw(game_rec['match_id'])
-            if game_rec['rated'] is True:
-                GameStorage.db.add_user_stats_draw(ctx.guild_id, game_rec['user_id'])
-                GameStorage.db.add_user_stats_draw(ctx.guild_id, game_rec['opponent_id'])
-
-        if current_game.board.is_checkmate():
-            winner_id = ctx.user.id
-            loser_id = game_rec['opponent_id'] if game_rec['user_id'] == ctx.user.id else game_rec['user_id']
-            GameStorage.db.match_won(game_rec['match_id'], winner_id, loser_id)
-            if game_rec['rated'] is True:
-                GameStorage.db.add_user_stats_win(ctx.guild_id, winner_id)
-                GameStorage.db.add_user_stats_loss(ctx.guild_id, loser_id)
+        # both parsers accept the null move ("0000" or "--") without checking it, and it's never a legal move
+        if not board_move:
+            return await self.send_error(ctx, description=f"Illegal move of {move}")
+
+        # the cached game is about to be modified, so drop it until the new state has been saved
+        self._game_cache.pop(game_rec['match_id'], None)
+        current_game.push(board_move)
+
+        _, outcome = current_game.end_state()
+        status = DBGameStates.IN_PROGRESS
+        if outcome:
+            # every automatic end other than checkmate is a draw, which is recorded like a stalemate
+            status = DBGameStates.WON if outcome.termination == Termination.CHECKMATE else DBGameStates.STALEMATE
+
+        game_state = current_game.to_dict()
+        saved = await GameStorage.db.finalize_move(game_rec['match_id'],
+                                                   ctx.channel_id,
+                                                   game_state,
+                                                   game_rec['version'],
+                                                   status,
+                                                   ctx.guild_id,
+                                                   game_rec['user_id'],
+                                                   game_rec['opponent_id'],
+                                                   game_rec['rated'] is True,
+                                                   winner_id=ctx.user.id)
+        if not saved:
+            # another move was saved while this one was being made, so this one was played on an outdated board
+            return await self.send_error(ctx, "The game changed while your move was being made, please try again")
+
+        if status == DBGameStates.IN_PROGRESS:
+            self._cache_game(game_rec['version'] + 1, current_game)
 
         await self.render_game_board(ctx, current_game)
 
@@ -339,11 +520,11 @@ class Chess(commands.Cog):
         """
         Re-shows the current board in cases where the message that contained the board has been deleted.
         """
-        game_rec = GameStorage.db.get_current_game(ctx.channel_id)
+        game_rec = await GameStorage.db.get_current_game(ctx.channel_id)
         if not game_rec:
             return await self.send_error(ctx, description="No game is currently in progress")
 
-        current_game = await self.convert_game_state_to_game(game_rec['game_state'])
+        current_game = self._load_game(game_rec)
 
         await self.render_game_board(ctx, current_game)
 
@@ -355,27 +536,31 @@ class Chess(commands.Cog):
         :param ctx:
         :return:
         """
-        game_rec = GameStorage.db.get_current_game(ctx.channel_id)
+        game_rec = await GameStorage.db.get_current_game(ctx.channel_id)
         if not game_rec:
             await self.send_error(ctx, "No active games were found.  Use `/new` to start a new match.")
             return
 
-        if ctx.user.id not in [game_rec['user_id'], game_rec['opponent_id']]:
+        if ctx.user.id != game_rec['user_id'] and ctx.user.id != game_rec['opponent_id']:
             await self.send_error(ctx, "You are not a participant in the current game, so you can't surrender")
             return
 
+        current_game = self._load_game(game_rec)
+
         loser_id = ctx.user.id
         if game_rec['user_id'] == ctx.user.id:
             winner_id = game_rec['opponent_id']
         else:
             winner_id = game_rec['user_id']
 
-        GameStorage.db.surrender_game(game_rec['match_id'], winner_id, loser_id)
-        if game_rec['rated'] is True:
-            GameStorage.db.add_user_stats_win(ctx.guild_id, winner_id)
-            GameStorage.db.add_user_stats_loss(ctx.guild_id, loser_id)
+        await GameStorage.db.surrender_match(game_rec['match_id'],
+                                             ctx.channel_id,
+                                             ctx.guild_id,
+                                             winner_id,
+                                             loser_id,
+                                             game_rec['rated'] is True)
+        self._game_cache.pop(game_rec['match_id'], None)
 
-        current_game = await self.convert_game_state_to_game(game_rec['game_state'])
         await self.render_game_board(ctx,
                                      current_game,
                                      message=f"**{ctx.user.name} has Surrendered!**",
@@ -384,11 +569,21 @@ class Chess(commands.Cog):
     @discord.app_commands.command(name="leaderboard",
                                   description="Top 10 ChessBot Players")
     async def leaderboard(self, ctx):
-        leaders = GameStorage.db.get_leaderboard(ctx.guild_id)
+        leaders = await GameStorage.db.get_leaderboard(ctx.guild_id)
+
+        # resolve all the users up front, fetching the ones missing from the cache concurrently so that a cold
+        # cache doesn't leave the leaderboard empty
+        users = [self._get_member_by_id(leader['user_id']) for leader in leaders]
+        missing = [idx for idx, user in enumerate(users) if user is None]
+        if missing:
+            fetched = await asyncio.gather(*[self.bot.fetch_user(leaders[idx]['user_id']) for idx in missing],
+                                           return_exceptions=True)
+            for idx, user in zip(missing, fetched):
+                if isinstance(user, discord.User):
+                    users[idx] = user
 
         embed = discord.Embed(title="ChessBot Leaderboard")
-        for idx, leader in enumerate(leaders):
-            user = self._get_member_by_id(leader['user_id'])
+        for idx, (leader, user) in enumerate(zip(leaders, users)):
             if user:
                 embed.add_field(name=f"#{idx + 1} - {user.name}",
                                 value=f"> Ratio:  {(leader['win_ratio'] * 100):.2f}%\n"
@@ -404,7 +599,7 @@ class Chess(commands.Cog):
         if user is None:
             user = ctx.user
 
-        stats = GameStorage.db.get_user_stats(ctx.guild_id, user.id)
+        stats = await GameStorage.db.get_user_stats(ctx.guild_id, user.id)
         if stats is None:
             stats = {
                 "wins": 0,
@@ -430,78 +625,114 @@ class Chess(commands.Cog):
         """
         white_user = self._get_member_by_id(current_game.white_id)
         black_user = self._get_member_by_id(current_game.black_id)
+        white_turn = current_game.board.turn == WHITE
 
-        embed = discord.Embed()
-        embed.add_field(name='',
-                        value=f"**White**: {white_user.mention} {('', '*(your turn)*')[current_game.board.turn]}",
-                        inline=False)
-        embed.add_field(name='',
-                        value=f"**Black**: {black_user.mention} {('*(your turn)*', '')[current_game.board.turn]}",
-                        inline=False)
+        # everything but the PGN goes in the description, one line each, rather than in separate embed fields
+        lines = [f"**White**: {white_user.mention} {'*(your turn)*' if white_turn else ''}",
+                 f"**Black**: {black_user.mention} {'' if white_turn else '*(your turn)*'}"]
 
         if current_game.last_move_san:
-            embed.add_field(name='',
-                            value=f"**Last move**: {current_game.last_move_san}",
-                            inline=False)
+            lines.append(f"**Last move**: {current_game.last_move_san}")
+
+        is_check, outcome = current_game.end_state()
+        termination = outcome.termination if outcome else None
 
-        if current_game.board.is_stalemate():
+        if outcome and termination != Termination.CHECKMATE:
             show_pgn = True
-            embed.add_field(name='',
-                            value="**Stalemate! The game is a draw!**", inline=False)
+            lines.append(f"**{self._draw_reason(outcome)}! The game is a draw!**")
 
-        if current_game.board.is_check() and not current_game.board.is_checkmate():
-            embed.add_field(name='',
-                            value="**Check!**",
-                            inline=False)
+        if is_check and termination != Termination.CHECKMATE:
+            lines.append("**Check!**")
 
-        if current_game.board.is_checkmate():
+        if termination == Termination.CHECKMATE:
             show_pgn = True
-            embed.add_field(name='',
-                            value=f"**Checkmate! "
-                                  f"{(white_user.name, black_user.name)[current_game.board.turn]} "
-                                  f"Has Won!**")
+            # the side to move is the one that has been checkmated
+            winner = black_user if white_turn else white_user
+            lines.append(f"**Checkmate! {winner.name} Has Won!**")
 
         # Option message that may be passed in from the caller
         if message:
-            embed.add_field(name='',
-                            value=message,
-                            inline=False)
+            lines.append(message)
+
+        embed = discord.Embed(description="\n".join(lines))
 
         if show_pgn:
             embed.add_field(name='PGN',
                             value=f"```{self.get_pgn(current_game)}```",
                             inline=False)
 
-        board_image = Chess.get_binary_board(current_game.board)
-        embed.set_image(url="attachment://board.jpg")
+        board_image = await self.get_binary_board(current_game, ctx.channel_id)
+        embed.set_image(url="attachment://board.webp")
 
         await ctx.response.send_message(embed=embed, file=board_image)
 
-    @staticmethod
-    def get_binary_board(board) -> discord.File:
+    async def get_binary_board(self, game, channel_id: int = None) -> discord.File:
         """
-        Generate the image of the board's current state, with all the pieces
-        :param board:
+        Generate the image of the board's current state, with all the pieces.  Rendering is done in a separate
+        process so it doesn't block the event loop, and the result is cached since the image only depends on the
+        position and the highlighted last move, which avoids re-rendering identical boards such as repeated /show calls.
+        :param game:
+        :param channel_id: if given, the last image sent to this channel is reused when the board hasn't changed
         :return:
         """
-        size = (500, 500)
+        # only the piece placement and the highlighted move are drawn, so the turn, castling rights and clocks in the
+        # full FEN would just split identical images across different cache keys
+        key = (game.board.board_fen(), game.moves[-1] if game.moves else None)
+
+        if self._starting_board_image and key == (STARTING_BOARD_FEN, None):
+            return discord.File(fp=io.BytesIO(self._starting_board_image), filename="board.webp")
+
+        last_board = self._last_board_image.get(channel_id)
+        if last_board and last_board[0] == key:
+            self._last_board_image.move_to_end(channel_id)
+            return discord.File(fp=io.BytesIO(last_board[1]), filename="board.webp")
+
+        image = self._board_img_cache.get(key)
+        if image is None:
+            image = await asyncio.get_running_loop().run_in_executor(self._render_pool, _render_fen_to_image, *key)
+            self._board_img_cache[key] = image
+            if len(self._board_img_cache) > self.board_img_cache_size:
+                self._board_img_cache.popitem(last=False)
+        else:
+            self._board_img_cache.move_to_end(key)
 
-        with io.BytesIO() as binary:
-            board = Generator.generate(board).resize(size, Image.Resampling.BICUBIC)
-            board.save(binary, "JPEG", quality=95, subsampling=0)
-            binary.seek(0)
-            return discord.File(fp=binary, filename="board.jpg")
+        if channel_id is not None:
+            self._last_board_image[channel_id] = (key, image)
+            self._last_board_image.move_to_end(channel_id)
+            if len(self._last_board_image) > self.last_board_image_cache_size:
+                self._last_board_image.popitem(last=False)
 
-    @staticmethod
-    def get_pgn(game):
-        export = pgn.Game()
-        for idx, move in enumerate(game.board.move_stack):
-            if idx == 0:
-                node = export.add_variation(move)
-            else:
-                node = node.add_variation(move)
+        return discord.File(fp=io.BytesIO(image), filename="board.webp")
+
+    def get_pgn(self, game):
+        """
+        Export the moves of the game as PGN.  The PGN tree and its text are cached per match, so if only one move
+        has been played since the last export it is appended to the tree instead of rebuilding it from scratch.
+        :param game:
+        :return: the PGN text of the game, without headers
+        """
+        moves = game.moves
+        cached = self._pgn_cache.get(game.match_id)
+
+        if cached and cached[0] == len(moves):
+            return cached[3]
+
+        if cached and cached[0] == len(moves) - 1:
+            export = cached[1]
+            node = cached[2].add_variation(Move.from_uci(moves[-1]))
+        else:
+            export = pgn.Game()
+            node = export
+            for move in moves:
+                node = node.add_variation(Move.from_uci(move))
 
-        return export.accept(StringExporter(headers=False, columns=None))
+        pgn_text = export.accept(StringExporter(headers=False, columns=None))
+        self._pgn_cache[game.match_id] = (len(moves), export, node, pgn_text)
+        self._pgn_cache.move_to_end(game.match_id)
+        if len(self._pgn_cache) > self.game_cache_size:
+            self._pgn_cache.popitem(last=False)
+
+        return pgn_text
 
 
 @bot.event
@@ -522,10 +753,21 @@ async def on_ready() -> None:
 
 
 async def main():
+    """
+    Initializes everything and runs the bot on a single event loop, so that the storage connection pool and
+    anything else created here is bound to the same loop the bot uses.
+    :return:
+    """
     Settings.init()
-    GameStorage.init()
-    await bot.add_cog(Chess(bot))
+    async with bot:
+        await GameStorage.init()
+        try:
+            await bot.add_cog(Chess(bot))
+            await bot.start(Settings.bot_token)
+        finally:
+            # writes any queued stats updates and closes the DB connections
+            await GameStorage.close()
 
 
-asyncio.run(main())
-bot.run(Settings.bot_token)
+if __name__ == "__main__":
+    asyncio.run(main())
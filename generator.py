@@ -1,5 +1,5 @@
 from PIL import Image
-from typing import Union
+from typing import Optional, Union
 
 import chess
 
@@ -15,27 +15,37 @@ class Generator:
         [ chess.A1, chess.B1, chess.C1, chess.D1, chess.E1, chess.F1, chess.G1, chess.H1 ]
     ]
 
+    # pixel offsets of the squares in the 718x718 source chessboard image
     coordinates = [ 25, 109, 194, 279, 363, 448, 531, 616 ]
 
+    # the board is rendered directly at this size, by scaling the source images down once when they're first used
+    size = 500
+    scale = size / 718
+
+    images = {}
+
     @staticmethod
-    def generate(board: chess.Board) -> Image:
-        chessboard = Image.open("resources/chessboard.png")
-        highlight = Image.open("resources/cell_highlight.png")
+    def generate(board: chess.Board, last_move: Optional[chess.Move] = None) -> Image:
+        chessboard = Generator.image("resources/chessboard.png", "RGB").copy()
+        highlight = Generator.image("resources/cell_highlight.png")
 
-        last_move = None
-        if len(board.move_stack) > 0:
+        coordinates = [ round(coordinate * Generator.scale) for coordinate in Generator.coordinates ]
+        border = round(3 * Generator.scale)
+
+        if last_move is None and len(board.move_stack) > 0:
             last_move = board.move_stack[-1]
 
-            x = Generator.coordinates[chess.square_file(last_move.from_square)] - 3
-            y = Generator.coordinates[7 - chess.square_rank(last_move.from_square)] - 3
+        if last_move is not None:
+            x = coordinates[chess.square_file(last_move.from_square)] - border
+            y = coordinates[7 - chess.square_rank(last_move.from_square)] - border
             chessboard.paste(highlight, (x, y), highlight)
 
-            x = Generator.coordinates[chess.square_file(last_move.to_square)] - 3
-            y = Generator.coordinates[7 - chess.square_rank(last_move.to_square)] - 3
+            x = coordinates[chess.square_file(last_move.to_square)] - border
+            y = coordinates[7 - chess.square_rank(last_move.to_square)] - border
             chessboard.paste(highlight, (x, y), highlight)
 
-        for y, Y in enumerate(Generator.coordinates):
-            for x, X in enumerate(Generator.coordinates):
+        for y, Y in enumerate(coordinates):
+            for x, X in enumerate(coordinates):
                 piece = board.piece_at(Generator.layout[y][x])
 
                 if piece is not None:
@@ -43,12 +53,25 @@ class Generator:
                 else:
                     continue
 
-                piece = Image.open(path).convert("RGBA")
-                
+                piece = Generator.image(path)
+
                 chessboard.paste(piece, (X, Y), piece)
 
         return chessboard
 
+    @staticmethod
+    def image(path: str, mode: str = "RGBA") -> Image:
+        image = Generator.images.get(path)
+
+        if image is None:
+            image = Image.open(path).convert(mode)
+            width, height = image.size
+            size = (round(width * Generator.scale), round(height * Generator.scale))
+            image = image.resize(size, Image.Resampling.BICUBIC)
+            Generator.images[path] = image
+
+        return image
+
     @staticmethod
     def path(piece: chess.Piece) -> Union[str, None]:
         path = "resources/"
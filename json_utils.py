@@ -0,0 +1,34 @@
+"""
+JSON helpers that use orjson when it's installed, and fall back to the stdlib json module otherwise.
+"""
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+
+def dumps(obj) -> str:
+    """
+    Serialize an object to compact JSON.  This returns a str rather than orjson's bytes, because psycopg before
+    3.1.10 encodes whatever its JSON dumps function returns.
+    :param obj:
+    :return:
+    """
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def loads(data):
+    """
+    Deserialize JSON from a str, or bytes-like object
+    :param data:
+    :return:
+    """
+    if orjson:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
@@ -0,0 +1,10 @@
+class DBGameStates:
+
+    INVITE = "invite"
+    IN_PROGRESS = "in-progress"
+    DECLINED = "declined"
+    CANCELLED = "cancelled"
+    DONE = "done"
+    STALEMATE = "stalemate"
+    SURRENDERED = "surrendered"
+    WON = "won"
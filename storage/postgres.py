@@ -1,222 +1,595 @@
-import psycopg
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import json_utils
+from psycopg.conninfo import conninfo_to_dict
+from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb, set_json_dumps, set_json_loads
+from psycopg_pool import AsyncConnectionPool
+from storage import DBGameStates
 
-
-class DBGameStates:
-
-    INVITE = "invite"
-    IN_PROGRESS = "in-progress"
-    DECLINED = "declined"
-    CANCELLED = "cancelled"
-    DONE = "done"
-    STALEMATE = "stalemate"
-    SURRENDERED = "surrendered"
-    WON = "won"
+log = logging.getLogger(__name__)
 
 
 class PostgresStorage:
 
-    def __init__(self, connection_string):
+    # hosts that are rewritten to the Unix socket directory, when one is configured
+    local_hosts = ("localhost", "127.0.0.1", "::1")
+    # number of channels whose current match record is kept in memory
+    current_game_cache_size = 1024
+    # seconds a query waits for a connection from the pool before failing, kept under the 3 seconds Discord gives a
+    # command to respond
+    connection_timeout = 2.0
+    # seconds that stats updates are collected for before they're written together
+    stats_flush_interval = 1.0
+
+    def __init__(self, connection_string, socket_dir=None):
         self.connection_string = connection_string
-        self._connection: psycopg.Connection = self._connect()
-        self._check_tables()
-
-    def _connect(self):
-        connection = psycopg.connect(self.connection_string)
-        connection.autocommit = True
-        return connection
-
-    def _create_matches_table(self):
-        cursor = self._connection.cursor()
-        cursor.execute("create table matches ( "
-                       " match_id serial primary key, "
-                       " guild_id bigint, "
-                       " channel_id bigint, "
-                       " game_state text, "
-                       " user_id bigint, "
-                       " opponent_id bigint, "
-                       " winner_id bigint, "
-                       " loser_id bigint, "
-                       " rated boolean default TRUE, "
-                       " status varchar(20),"
-                       " created_at timestamptz default now() "
-                       ");")
-
-        cursor.execute("create index idx_channel_status on matches (channel_id, status)")
-
-    def _create_stats_table(self):
-        cursor = self._connection.cursor()
-        cursor.execute("create table user_stats ( "
-                       " user_stat_id serial primary key, "
-                       " guild_id bigint, "
-                       " user_id bigint, "
-                       " wins int default 0, "
-                       " losses int default 0, "
-                       " draws int default 0, "
-                       " win_ratio numeric(5, 3) default 0, "
-                       " unique(guild_id, user_id)"
-                       ");")
-
-        cursor.execute("create unique index idx_user_guild on user_stats (user_id, guild_id)")
-
-    def _check_tables(self):
-        """
-        Check for missing tables and create them if necessary
+        kwargs = {"autocommit": True, "row_factory": dict_row}
+        kwargs.update(self._connection_params(connection_string, socket_dir))
+        self._pool = AsyncConnectionPool(self.connection_string,
+                                         min_size=2,
+                                         max_size=10,
+                                         max_idle=600,
+                                         kwargs=kwargs,
+                                         configure=self._configure_connection,
+                                         timeout=self.connection_timeout,
+                                         open=False)
+        self._schema_ready = False
+        self._schema_lock = asyncio.Lock()
+        # stats updates waiting to be written, as [wins, losses, draws] deltas keyed by (guild_id, user_id)
+        self._pending_stats = {}
+        self._stats_lock = asyncio.Lock()
+        self._stats_flush_task = None
+        self._stats_flush_sleeping = False
+        self._closing = False
+        # the in-progress match record of each channel, or None if it has no match, keyed by channel_id
+        self._current_game_cache = OrderedDict()
+        # bumped by every change to the matches, so a read that overlapped one isn't cached
+        self._current_game_generation = 0
+
+    @classmethod
+    def _connection_params(cls, connection_string, socket_dir):
+        """
+        Work out the connection parameters that override the connection string.  When the DB runs on the same host
+        and a socket directory is given, connect over the Unix socket instead of TCP, which is cheaper for the many
+        small queries the bot makes.  Otherwise keep idle TCP connections in the pool alive.
+        :param connection_string:
+        :param socket_dir: the directory of the Postgres Unix socket, such as /var/run/postgresql
+        :return: a dict of libpq connection parameters
+        """
+        params = conninfo_to_dict(connection_string)
+        if socket_dir and params.get("host", "localhost") in cls.local_hosts:
+            return {"host": socket_dir}
+        if "keepalives_idle" not in params:
+            return {"keepalives_idle": 60}
+        return {}
+
+    @classmethod
+    async def create(cls, connection_string, socket_dir=None):
+        """
+        Build the storage and start opening its connection pool.  The pool is shared by every command, so the
+        connection handshake only happens once per connection instead of on each query.  The connections are made in
+        the background, so the bot doesn't wait on a slow or unavailable DB to come online, and the schema is
+        checked on first use.
+        :param connection_string:
+        :param socket_dir: the directory of the Postgres Unix socket to use for a local DB, if any
+        :return: a PostgresStorage instance
+        """
+        storage = cls(connection_string, socket_dir)
+        await storage._pool.open(wait=False)
+        return storage
+
+    async def close(self):
+        """
+        Write any queued stats updates and close the connection pool.  The storage can't be used afterwards.
+        :return:
+        """
+        self._closing = True
+        task = self._stats_flush_task
+        if task is not None and not task.done():
+            if self._stats_flush_sleeping:
+                task.cancel()
+            # a flush that is already writing is left to finish, rather than cancelled part way through its batch
+            await asyncio.wait([task])
+        try:
+            await self.flush_stats()
+        finally:
+            await self._pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @staticmethod
+    async def _configure_connection(conn):
+        """
+        Called for every new connection in the pool.  The game state is stored as jsonb, so convert it to and from
+        Python dicts with orjson, when it's available, instead of the stdlib json module.  The dumps function must
+        return a str, as the pinned psycopg encodes its result itself.
+        :param conn:
+        :return:
+        """
+        set_json_dumps(json_utils.dumps, conn)
+        set_json_loads(json_utils.loads, conn)
+
+    @asynccontextmanager
+    async def _connection(self):
+        """
+        Borrow a connection from the pool, making sure the schema exists first
+        :return:
+        """
+        await self._ensure_schema()
+        async with self._pool.connection() as conn:
+            yield conn
+
+    async def _ensure_schema(self):
+        """
+        Create the schema the first time the DB is used.  The lock makes concurrent first queries wait on a
+        single schema check.
+        :return:
+        """
+        if self._schema_ready:
+            return
+        async with self._schema_lock:
+            if not self._schema_ready:
+                await self._create_schema()
+                self._schema_ready = True
+
+    async def _create_schema(self):
+        """
+        Create the tables and indexes if they don't exist yet, and migrate tables created by older versions of the
+        bot.  Every statement is idempotent, so the whole schema is sent in a single batch on each startup instead of
+        probing the catalog first.
+        :return:
+        """
+        async with self._pool.connection() as conn:
+            await conn.execute("create table if not exists matches ( "
+                               " match_id serial primary key, "
+                               " guild_id bigint, "
+                               " channel_id bigint, "
+                               " game_state jsonb, "
+                               " user_id bigint, "
+                               " opponent_id bigint, "
+                               " winner_id bigint, "
+                               " loser_id bigint, "
+                               " rated boolean default TRUE, "
+                               " status varchar(20),"
+                               " version bigint default 0, "
+                               " created_at timestamptz default now() "
+                               "); "
+                               "alter table matches add column if not exists version bigint default 0; "
+                               # older versions stored the game state as text
+                               "do $$ begin "
+                               " if (select atttypid from pg_attribute "
+                               "     where attrelid='public.matches'::regclass "
+                               "     and attname='game_state') <> 'jsonb'::regtype then "
+                               "  alter table matches alter column game_state type jsonb using game_state::jsonb; "
+                               " end if; "
+                               "end $$; "
+                               "create index if not exists idx_channel_status on matches (channel_id, status); "
+                               "create table if not exists user_stats ( "
+                               " user_stat_id serial primary key, "
+                               " guild_id bigint, "
+                               " user_id bigint, "
+                               " wins int default 0, "
+                               " losses int default 0, "
+                               " draws int default 0, "
+                               " unique(guild_id, user_id)"
+                               "); "
+                               # win_ratio is generated from the counters, and older versions stored it as a plain
+                               # column updated by every stats write
+                               "do $$ begin "
+                               " if exists (select from pg_attribute "
+                               "            where attrelid='public.user_stats'::regclass "
+                               "            and attname='win_ratio' and attgenerated='') then "
+                               "  alter table user_stats drop column win_ratio; "
+                               " end if; "
+                               "end $$; "
+                               "alter table user_stats add column if not exists win_ratio numeric(5, 3) "
+                               "generated always as ("
+                               " case when wins + losses + draws = 0 then 0 "
+                               " else wins::numeric / (wins + losses + draws / 2.0) end"
+                               ") stored; "
+                               # the unique constraint already indexes the players, older versions added a second
+                               "drop index if exists idx_user_guild; "
+                               "create index if not exists idx_leaderboard on user_stats (guild_id, win_ratio desc);")
+
+    async def new_match(self, guild_id, channel_id, user_id, opponent_id, rated):
+        """
+        Create an invite for a new match
+        :return: the match_id of the new invite
+        """
+        async with self._connection() as conn:
+            cursor = await conn.execute("insert into matches "
+                                        "  (guild_id, channel_id, user_id, opponent_id, rated, status) "
+                                        " values "
+                                        "  (%s, %s, %s, %s, %s, %s) "
+                                        "returning match_id",
+                                        (guild_id, channel_id, user_id, opponent_id, rated, DBGameStates.INVITE),
+                                        binary=True)
+            row = await cursor.fetchone()
+            return row['match_id']
+
+    async def bulk_insert_matches(self, rows):
+        """
+        Load many matches at once, such as when importing the history of a guild.  The rows are streamed with COPY,
+        which is much faster than an insert per match.  new_match remains the way to create a single match.  Rows with
+        the invite status are imported as open invites, but the Chess cog keeps its own cache of those, so call its
+        forget_open_invites afterwards for them to be seen by /accept, /decline and /cancel.
+        :param rows: an iterable of (guild_id, channel_id, user_id, opponent_id, rated, status) tuples
+        :return:
+        """
+        async with self._connection() as conn:
+            cursor = conn.cursor()
+            async with cursor.copy("copy matches "
+                                   " (guild_id, channel_id, user_id, opponent_id, rated, status) "
+                                   "from stdin") as copy:
+                for row in rows:
+                    await copy.write_row(row)
+        # the imported matches may be in progress in channels that are cached as having none
+        self._current_game_generation += 1
+        self._current_game_cache.clear()
+
+    async def get_open_invites(self, channel_id):
+        async with self._connection() as conn:
+            cursor = await conn.execute("select match_id, user_id, opponent_id "
+                                        "from matches where channel_id=%s and status=%s",
+                                        (channel_id, DBGameStates.INVITE),
+                                        binary=True)
+            return await cursor.fetchone()
+
+    async def accept_invite(self, match_id, channel_id, opponent_id):
+        async with self._connection() as conn:
+            await conn.execute("update matches set opponent_id=%s, status=%s where match_id=%s",
+                               (opponent_id, DBGameStates.IN_PROGRESS, match_id),
+                               prepare=True)
+        self._forget_current_game(channel_id)
+
+    async def start_match(self, match_id, channel_id, opponent_id, game_state):
+        """
+        Accept an invite and save the initial game state in a single statement, so the caller only waits on a single
+        DB operation and a match is never in progress without a game state.  The invite is only claimed if it's still
+        open, so two players accepting it at the same time can't both start the match.
+        :param match_id:
+        :param channel_id:
+        :param opponent_id:
+        :param game_state:
+        :return: True if the match was started, False if the invite is no longer open
+        """
+        async with self._connection() as conn:
+            cursor = await conn.execute("update matches "
+                                        "set opponent_id=%s, status=%s, game_state=%s, version=version + 1 "
+                                        "where match_id=%s and status=%s "
+                                        "returning match_id",
+                                        (opponent_id, DBGameStates.IN_PROGRESS, Jsonb(game_state), match_id,
+                                         DBGameStates.INVITE),
+                                        prepare=True,
+                                        binary=True)
+            started = await cursor.fetchone() is not None
+        self._forget_current_game(channel_id)
+        return started
+
+    async def decline_invite(self, match_id):
+        async with self._connection() as conn:
+            await conn.execute("update matches set status=%s where match_id=%s",
+                               (DBGameStates.DECLINED, match_id))
+
+    async def cancel_invite(self, match_id):
+        async with self._connection() as conn:
+            await conn.execute("update matches set status=%s where match_id=%s",
+                               (DBGameStates.CANCELLED, match_id))
+
+    async def decline_invite_in_channel(self, channel_id, opponent_id):
+        """
+        Find and decline the open invite sent to a player in a channel, in a single statement
+        :param channel_id:
+        :param opponent_id: the player declining the invite
+        :return: the declined invite record, or None if there was no open invite for the player
+        """
+        async with self._connection() as conn:
+            cursor = await conn.execute("update matches set status=%s "
+                                        "where channel_id=%s and status=%s and opponent_id=%s "
+                                        "returning match_id, user_id, opponent_id",
+                                        (DBGameStates.DECLINED, channel_id, DBGameStates.INVITE, opponent_id),
+                                        binary=True)
+            return await cursor.fetchone()
+
+    async def cancel_invite_in_channel(self, channel_id, user_id):
+        """
+        Find and cancel the open invite a player made in a channel, in a single statement
+        :param channel_id:
+        :param user_id: the player cancelling their invite
+        :return: the cancelled invite record, or None if the player had no open invite
+        """
+        async with self._connection() as conn:
+            cursor = await conn.execute("update matches set status=%s "
+                                        "where channel_id=%s and status=%s and user_id=%s "
+                                        "returning match_id, user_id, opponent_id",
+                                        (DBGameStates.CANCELLED, channel_id, DBGameStates.INVITE, user_id),
+                                        binary=True)
+            return await cursor.fetchone()
+
+    async def get_current_game(self, channel_id):
+        """
+        Get the in-progress match record of a channel.  The bot is the only writer of the matches, so once read the
+        record is kept, including when there is no match, until one of the methods that changes the match of the
+        channel updates or forgets it.
+        :param channel_id:
+        :return: the match record, or None if no match is in progress
+        """
+        if channel_id in self._current_game_cache:
+            self._current_game_cache.move_to_end(channel_id)
+            return self._current_game_cache[channel_id]
+
+        generation = self._current_game_generation
+
+        async with self._connection() as conn:
+            cursor = await conn.execute("select match_id, game_state, user_id, opponent_id, rated, version "
+                                        "from matches "
+                                        "where channel_id=%s and status=%s",
+                                        (channel_id, DBGameStates.IN_PROGRESS),
+                                        prepare=True,
+                                        binary=True)
+            game_rec = await cursor.fetchone()
+
+        # a match that changed while the query was running may have been read before the change, so only keep
+        # the record if nothing changed, otherwise the next read queries again
+        if generation == self._current_game_generation:
+            self._current_game_cache[channel_id] = game_rec
+            if len(self._current_game_cache) > self.current_game_cache_size:
+                self._current_game_cache.popitem(last=False)
+        return game_rec
+
+    def _forget_current_game(self, channel_id):
+        """
+        Drop the cached match record of a channel after a change to its match
+        :param channel_id:
+        :return:
+        """
+        self._current_game_generation += 1
+        self._current_game_cache.pop(channel_id, None)
+
+    async def _end_match(self, match_id, channel_id, status, winner_id=None, loser_id=None):
+        """
+        Record the result of a match.  Every way a match can end shares this statement, so one prepared plan
+        serves them all.
+        :param match_id:
+        :param channel_id:
+        :param status:
+        :param winner_id:
+        :param loser_id:
+        :return:
+        """
+        async with self._connection() as conn:
+            await conn.execute("update matches set status=%s, winner_id=%s, loser_id=%s where match_id=%s",
+                               (status, winner_id, loser_id, match_id),
+                               prepare=True)
+        self._forget_current_game(channel_id)
+
+    async def surrender_game(self, match_id, channel_id, winner_id, loser_id):
+        await self._end_match(match_id, channel_id, DBGameStates.SURRENDERED, winner_id, loser_id)
+
+    async def surrender_match(self, match_id, channel_id, guild_id, winner_id, loser_id, rated):
+        """
+        Record a surrender and, for a rated match, queue the win and loss of the players
+        :param match_id:
+        :param channel_id:
+        :param guild_id:
+        :param winner_id:
+        :param loser_id: the player who surrendered
+        :param rated: whether the player stats should be updated
+        :return:
+        """
+        await self.surrender_game(match_id, channel_id, winner_id, loser_id)
+        if rated:
+            await self.add_user_stats_win(guild_id, winner_id)
+            await self.add_user_stats_loss(guild_id, loser_id)
+
+    async def match_won(self, match_id, channel_id, winner_id, loser_id):
+        await self._end_match(match_id, channel_id, DBGameStates.WON, winner_id, loser_id)
+
+    async def match_draw(self, match_id, channel_id):
+        await self._end_match(match_id, channel_id, DBGameStates.STALEMATE)
+
+    async def save_game_state(self, match_id, channel_id, game_state, version):
+        """
+        Save the game state of a match, as long as it hasn't been saved by anybody else since it was read
+        :param match_id:
+        :param channel_id:
+        :param game_state:
+        :param version: the version of the game state the new one was made from
+        :return: True if the game state was saved, False if the stored version has changed
+        """
+        async with self._connection() as conn:
+            cursor = await conn.execute("update matches "
+                                        "set game_state=%s, version=version + 1 "
+                                        "where match_id=%s and version=%s "
+                                        "returning match_id",
+                                        (Jsonb(game_state), match_id, version),
+                                        prepare=True,
+                                        binary=True)
+            saved = await cursor.fetchone() is not None
+
+        # the new state is known, so update the cached record instead of reading it back on the next move
+        game_rec = self._current_game_cache.get(channel_id)
+        if saved and game_rec and game_rec['match_id'] == match_id and game_rec['version'] == version:
+            self._current_game_generation += 1
+            self._current_game_cache[channel_id] = dict(game_rec,
+                                                        game_state=game_state,
+                                                        version=version + 1)
+        else:
+            self._forget_current_game(channel_id)
+        return saved
+
+    async def save_final_game_state(self, match_id, channel_id, game_state, version, status, winner_id, loser_id):
+        """
+        Save the last game state of a finished match together with its result, in a single statement, as long as
+        the game state hasn't been saved by anybody else since it was read
+        :param match_id:
+        :param channel_id:
+        :param game_state:
+        :param version: the version of the game state the final one was made from
+        :param status:
+        :param winner_id:
+        :param loser_id:
+        :return: True if the game state was saved, False if the stored version has changed
+        """
+        async with self._connection() as conn:
+            cursor = await conn.execute("update matches "
+                                        "set game_state=%s, version=version + 1, status=%s, winner_id=%s, loser_id=%s "
+                                        "where match_id=%s and version=%s "
+                                        "returning match_id",
+                                        (Jsonb(game_state), status, winner_id, loser_id, match_id, version),
+                                        prepare=True,
+                                        binary=True)
+            saved = await cursor.fetchone() is not None
+        self._forget_current_game(channel_id)
+        return saved
+
+    async def finalize_move(self, match_id, channel_id, game_state, version, status, guild_id, user_id, opponent_id,
+                            rated, winner_id=None):
+        """
+        Persist the game state after a move and, if the move ended the match, record the result and queue the stats
+        updates of both players.  The final game state and the result are written by the same statement, so the
+        caller only waits on a single round trip.  Nothing is written if another move has been saved since the game
+        state was read, so two moves made from the same position can't both be played.
+        :param match_id:
+        :param channel_id:
+        :param game_state:
+        :param version: the version of the game state the move was made from
+        :param status: DBGameStates.IN_PROGRESS, DBGameStates.STALEMATE or DBGameStates.WON
+        :param guild_id:
+        :param user_id: the player who created the match
+        :param opponent_id: the player who accepted the match
+        :param rated: whether the player stats should be updated when the match ends
+        :param winner_id: the winning player, when the status is DBGameStates.WON
+        :return: True if the move was saved, False if the stored game state has changed since it was read
+        """
+        if status == DBGameStates.IN_PROGRESS:
+            return await self.save_game_state(match_id, channel_id, game_state, version)
+
+        loser_id = None
+        if status == DBGameStates.WON:
+            loser_id = opponent_id if winner_id == user_id else user_id
+        else:
+            winner_id = None
+
+        if not await self.save_final_game_state(match_id, channel_id, game_state, version, status, winner_id,
+                                                loser_id):
+            return False
+
+        if rated and status == DBGameStates.STALEMATE:
+            await self.add_user_stats_draw(guild_id, user_id)
+            await self.add_user_stats_draw(guild_id, opponent_id)
+
+        elif rated and status == DBGameStates.WON:
+            await self.add_user_stats_win(guild_id, winner_id)
+            await self.add_user_stats_loss(guild_id, loser_id)
+        return True
+
+    def _bump_stats(self, guild_id, user_id, wins, losses, draws):
+        """
+        Queue additions to the win, loss and draw counters of a player.  Updates are collected for
+        stats_flush_interval seconds and then written together, so a burst of finished matches costs a single round
+        trip, at the price of the stats being up to that long behind the match results.
+        :param guild_id:
+        :param user_id:
+        :param wins: the number of wins to add
+        :param losses: the number of losses to add
+        :param draws: the number of draws to add
+        :return:
+        """
+        deltas = self._pending_stats.setdefault((guild_id, user_id), [0, 0, 0])
+        deltas[0] += wins
+        deltas[1] += losses
+        deltas[2] += draws
+
+        if self._stats_flush_task is None or self._stats_flush_task.done():
+            self._stats_flush_task = asyncio.create_task(self._flush_stats_later())
+
+    async def _flush_stats_later(self):
+        """
+        Flush the queued stats updates every stats_flush_interval seconds for as long as there are any, which also
+        covers updates queued while a flush was writing and retries a flush that failed.
+        :return:
+        """
+        while self._pending_stats and not self._closing:
+            self._stats_flush_sleeping = True
+            try:
+                await asyncio.sleep(self.stats_flush_interval)
+            finally:
+                self._stats_flush_sleeping = False
+
+            try:
+                await self.flush_stats()
+            except Exception:
+                log.exception("Failed to write the stats updates, they will be retried")
+
+    async def flush_stats(self):
+        """
+        Write the queued stats updates, creating the stats of players who don't have any yet.  Every row uses the
+        same upsert, and executemany sends them all in one pipeline, inside a transaction so a failed batch can be
+        queued again as a whole.  win_ratio is generated from the counters by
+        the DB.  The stats are read back only after flushing, so they never look behind to the players.
         :return:
         """
-        cursor = self._connection.cursor()
-        cursor.execute("select table_name "
-                       "from information_schema.tables "
-                       "where table_schema='public' "
-                       "and table_type='BASE TABLE' ")
-        table_names = []
-        tables = cursor.fetchall()
-        for table in tables:
-            table_names.append(table[0])
-        if 'matches' not in table_names:
-            self._create_matches_table()
-        if 'user_stats' not in table_names:
-            self._create_stats_table()
-
-    def new_match(self, guild_id, channel_id, user_id, opponent_id, rated):
-        cursor = self._connection.cursor()
-        cursor.execute("insert into matches "
-                       "  (guild_id, channel_id, user_id, opponent_id, rated, status) "
-                       " values "
-                       "  (%s, %s, %s, %s, %s, %s) ",
-                       (guild_id, channel_id, user_id, opponent_id, rated, DBGameStates.INVITE))
-
-    def get_open_invites(self, channel_id):
-        cursor = self._connection.cursor()
-        cursor.execute("select match_id, user_id, opponent_id "
-                       "from matches where channel_id=%s and status=%s",
-                       (channel_id, DBGameStates.INVITE))
-        row = cursor.fetchone()
-        if row:
-            return {
-                "match_id": row[0],
-                "user_id": row[1],
-                "opponent_id": row[2]
-            }
-
-    def accept_invite(self, match_id, opponent_id):
-        cursor = self._connection.cursor()
-        cursor.execute("update matches set opponent_id=%s, status=%s where match_id=%s",
-                       (opponent_id, DBGameStates.IN_PROGRESS, match_id))
-
-    def decline_invite(self, match_id):
-        cursor = self._connection.cursor()
-        cursor.execute("update matches set status=%s where match_id=%s",
-                       (DBGameStates.DECLINED, match_id))
-
-    def cancel_invite(self, match_id):
-        cursor = self._connection.cursor()
-        cursor.execute("update matches set status=%s where match_id=%s",
-                       (DBGameStates.CANCELLED, match_id))
-
-    def get_current_game(self, channel_id):
-        cursor = self._connection.cursor()
-        cursor.execute("select match_id, game_state, user_id, opponent_id, rated "
-                       "from matches "
-                       "where channel_id=%s and status=%s",
-                       (channel_id, DBGameStates.IN_PROGRESS))
-        row = cursor.fetchone()
-        if row:
-            result = {
-                "match_id": row[0],
-                "game_state": row[1],
-                "user_id": row[2],
-                "opponent_id": row[3],
-                "rated": row[4]
-            }
-            return result
-
-    def surrender_game(self, match_id, winner_id, loser_id):
-        cursor = self._connection.cursor()
-        cursor.execute("update matches set status=%s, winner_id=%s, loser_id=%s where match_id=%s",
-                       (DBGameStates.SURRENDERED, winner_id, loser_id, match_id))
-
-    def match_won(self, match_id, winner_id, loser_id):
-        cursor = self._connection.cursor()
-        cursor.execute("update matches set status=%s, winner_id=%s, loser_id=%s where match_id=%s",
-                       (DBGameStates.WON, winner_id, loser_id, match_id))
-
-    def match_draw(self, match_id):
-        cursor = self._connection.cursor()
-        cursor.execute("update matches set status=%s where match_id=%s",
-                       (DBGameStates.STALEMATE, match_id))
-
-    def save_game_state(self, match_id, game_state):
-        cursor = self._connection.cursor()
-        cursor.execute("update matches "
-                       "set game_state=%s "
-                       "where match_id=%s",
-                       (game_state, match_id))
-
-    def add_user_stats_win(self, guild_id, user_id):
-        cursor = self._connection.cursor()
-        cursor.execute("insert into user_stats "
-                       " (guild_id, user_id, wins, win_ratio) "
-                       "values "
-                       " (%s, %s, 1, 1)"
-                       "on conflict on constraint user_stats_guild_id_user_id_key "
-                       "do update set "
-                       "wins = user_stats.wins + 1, "
-                       "win_ratio=(user_stats.wins + 1)::float / (user_stats.wins + user_stats.losses + 1 + (user_stats.draws::float / 2))",
-                       (guild_id, user_id))
-
-    def add_user_stats_loss(self, guild_id, user_id):
-        cursor = self._connection.cursor()
-        cursor.execute("insert into user_stats "
-                       " (guild_id, user_id, losses, win_ratio) "
-                       "values "
-                       " (%s, %s, 1, 0)"
-                       "on conflict on constraint user_stats_guild_id_user_id_key "
-                       "do update set "
-                       "losses = user_stats.losses + 1,"
-                       "win_ratio=(user_stats.wins)::float / (user_stats.wins + user_stats.losses + 1 + (user_stats.draws::float / 2))",
-                       (guild_id, user_id))
-
-    def add_user_stats_draw(self, guild_id, user_id):
-        cursor = self._connection.cursor()
-        cursor.execute("insert into user_stats "
-                       " (guild_id, user_id, draws, win_ratio) "
-                       "values "
-                       " (%s, %s, 1, 0)"
-                       "on conflict on constraint user_stats_guild_id_user_id_key "
-                       "do update set "
-                       "draws = user_stats.draws + 1,"
-                       "win_ratio=(user_stats.wins)::float / (user_stats.wins + user_stats.losses + 1 + (user_stats.draws::float / 2))",
-                       (guild_id, user_id))
-
-    def get_user_stats(self, guild_id, user_id):
-        cursor = self._connection.cursor()
-        cursor.execute("select wins, losses, draws, win_ratio  "
-                       "from user_stats where guild_id=%s and user_id=%s",
-                       (guild_id, user_id))
-        row = cursor.fetchone()
-        if row:
-            return {
-                "wins": row[0],
-                "losses": row[1],
-                "draws": row[2],
-                "win_ratio": row[3]
-            }
-
-    def get_leaderboard(self, guild_id):
-        results = []
-        cursor = self._connection.cursor()
-        cursor.execute("select user_id, wins, losses, draws, win_ratio  "
-                       "from user_stats where guild_id=%s "
-                       "order by win_ratio desc "
-                       "limit 10 ",
-                       [guild_id])
-        rows = cursor.fetchall()
-        for row in rows:
-            results.append({
-                "user_id": row[0],
-                "wins": row[1],
-                "losses": row[2],
-                "draws": row[3],
-                "win_ratio": row[4]
-            })
-        return results
+        async with self._stats_lock:
+            if not self._pending_stats:
+                return
+            pending, self._pending_stats = self._pending_stats, {}
+
+            try:
+                async with self._connection() as conn, conn.transaction():
+                    cursor = conn.cursor()
+                    await cursor.executemany("insert into user_stats "
+                                             " (guild_id, user_id, wins, losses, draws) "
+                                             "values "
+                                             " (%s, %s, %s, %s, %s) "
+                                             "on conflict (guild_id, user_id) "
+                                             "do update set "
+                                             "wins = user_stats.wins + excluded.wins, "
+                                             "losses = user_stats.losses + excluded.losses, "
+                                             "draws = user_stats.draws + excluded.draws",
+                                             [(guild_id, user_id, wins, losses, draws)
+                                              for (guild_id, user_id), (wins, losses, draws) in pending.items()])
+            except BaseException:
+                # keep the updates for the next flush rather than losing them, including when the flush is cancelled
+                for key, (wins, losses, draws) in pending.items():
+                    deltas = self._pending_stats.setdefault(key, [0, 0, 0])
+                    deltas[0] += wins
+                    deltas[1] += losses
+                    deltas[2] += draws
+                raise
+
+    async def add_user_stats_win(self, guild_id, user_id):
+        self._bump_stats(guild_id, user_id, 1, 0, 0)
+
+    async def add_user_stats_loss(self, guild_id, user_id):
+        self._bump_stats(guild_id, user_id, 0, 1, 0)
+
+    async def add_user_stats_draw(self, guild_id, user_id):
+        self._bump_stats(guild_id, user_id, 0, 0, 1)
+
+    async def get_user_stats(self, guild_id, user_id):
+        await self.flush_stats()
+        async with self._connection() as conn:
+            cursor = await conn.execute("select wins, losses, draws, win_ratio  "
+                                        "from user_stats where guild_id=%s and user_id=%s",
+                                        (guild_id, user_id),
+                                        binary=True)
+            return await cursor.fetchone()
+
+    async def get_leaderboard(self, guild_id):
+        await self.flush_stats()
+        async with self._connection() as conn:
+            cursor = await conn.execute("select user_id, wins, losses, draws, win_ratio  "
+                                        "from user_stats where guild_id=%s "
+                                        "order by win_ratio desc "
+                                        "limit 10 ",
+                                        [guild_id],
+                                        binary=True)
+            return await cursor.fetchall()